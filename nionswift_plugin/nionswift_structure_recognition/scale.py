@@ -1,5 +1,7 @@
+import os
+from functools import lru_cache
+
 import numpy as np
-from scipy import ndimage
 from scipy.ndimage import gaussian_filter
 
 from psm.geometry import regular_polygon, polygon_area
@@ -7,6 +9,17 @@ from psm.structures.utils import rotate
 from psm.rmsd import pairwise_rmsd
 from psm.graph import stable_delaunay_faces
 
+FFT_THREADS = max(min((os.cpu_count() or 1) // 2, 4), 1)
+
+try:
+    import pyfftw
+
+    def rfft2(image):
+        return pyfftw.interfaces.numpy_fft.rfft2(image, threads=FFT_THREADS)
+
+except ImportError:
+    rfft2 = np.fft.rfft2
+
 
 def cosine_window(x, cutoff, rolloff):
     rolloff *= cutoff
@@ -31,13 +44,53 @@ def square_crop(image):
     return image
 
 
-def windowed_fft(image):
-    image = square_crop(image)
-    x = np.fft.fftshift(np.fft.fftfreq(image.shape[0]))
-    y = np.fft.fftshift(np.fft.fftfreq(image.shape[1]))
+def abs2(f):
+    return f.real * f.real + f.imag * f.imag
+
+
+def real_power_spectrum(image):
+    # the input is real, so its power spectrum is point symmetric; only half of it is computed, the rest is mirrored
+    n = image.shape[1]
+    half = abs2(rfft2(image))
+    power = np.empty(image.shape, dtype=half.dtype)
+    power[:, :half.shape[1]] = half
+    power[0, half.shape[1]:] = half[0, 1:n - n // 2][::-1]
+    power[1:, half.shape[1]:] = half[:0:-1, 1:n - n // 2][:, ::-1]
+    return power
+
+
+@lru_cache(maxsize=4)
+def fft_window(shape):
+    x = np.fft.fftshift(np.fft.fftfreq(shape[0]))
+    y = np.fft.fftshift(np.fft.fftfreq(shape[1]))
     r = np.sqrt(x[:, None] ** 2 + y[None] ** 2)
     m = cosine_window(r, .5, .33)
-    return np.fft.fft2(image * m)
+    m.setflags(write=False)
+    return m
+
+
+def windowed_fft(image):
+    image = square_crop(image)
+    return np.fft.fft2(image * fft_window(image.shape))
+
+
+def windowed_power_spectrum(image):
+    image = square_crop(image)
+    return real_power_spectrum(image * fft_window(image.shape))
+
+
+def interpolate_bilinear(array, coordinates):
+    x, y = coordinates
+    x0 = np.clip(np.floor(x).astype(np.int32), 0, array.shape[0] - 2)
+    y0 = np.clip(np.floor(y).astype(np.int32), 0, array.shape[1] - 2)
+    dx = x - x0
+    dy = y - y0
+    values = ((1 - dx) * (1 - dy) * array[x0, y0] + dx * (1 - dy) * array[x0 + 1, y0] +
+              (1 - dx) * dy * array[x0, y0 + 1] + dx * dy * array[x0 + 1, y0 + 1])
+
+    # points outside the array are zero, as in map_coordinates with mode='constant'
+    inside = (x >= 0) & (x <= array.shape[0] - 1) & (y >= 0) & (y <= array.shape[1] - 1)
+    return np.where(inside, values, 0.)
 
 
 def detect_scale_fourier_space(image, template, symmetry, min_scale=None, max_scale=None, nbins_angular=16):
@@ -62,8 +115,8 @@ def detect_scale_fourier_space(image, template, symmetry, min_scale=None, max_sc
     if min_scale > max_scale:
         raise RuntimeError('min_scale must be less than max_scale')
 
-    f = windowed_fft(image)
-    f = np.log(np.abs(np.fft.fftshift(f)))
+    f = windowed_power_spectrum(image)
+    f = .5 * np.log(np.fft.fftshift(f).astype(np.float32))
     f = gaussian_filter(f, 1)
 
     # import matplotlib.pyplot as plt
@@ -79,7 +132,7 @@ def detect_scale_fourier_space(image, template, symmetry, min_scale=None, max_sc
     templates = np.array([np.cos(a) * r, np.sin(a) * r])
     templates = templates.reshape(2, -1) + np.array([f.shape[0] // 2, f.shape[1] // 2])[:, None]
 
-    unrolled = ndimage.map_coordinates(f, templates, order=1)
+    unrolled = interpolate_bilinear(f, templates)
     unrolled = unrolled.reshape((len(template), len(scales), len(angles)))
     unrolled = unrolled.mean(0) - unrolled.mean((0, 2), keepdims=True)[0]
 
@@ -116,42 +169,83 @@ class FourierSpaceCalibrator:
         return detect_scale_fourier_space(image, template, symmetry, min_scale=min_scale, max_scale=max_scale) / k
 
 
-def detect_scale_real_space(image, model, template, alpha, rmsd_max, min_sampling, max_sampling, step_size=.01):
-    max_valid = 0
-    best_sampling = None
+def evaluate_sampling(image, model, template, alpha, rmsd_max, sampling):
+    points = model(image, sampling)['points']
+    if len(points) < 3:
+        return 0., None
+
+    faces = stable_delaunay_faces(points, alpha)
+
+    segments = [points[face] for face in faces]
+    reference_area = polygon_area(template / sampling)
 
-    for sampling in np.linspace(min_sampling, max_sampling, int(np.ceil((max_sampling - min_sampling) / step_size))):
-        points = model(image, sampling)['points']
-        if len(points) < 3:
-            continue
+    rmsd = pairwise_rmsd([template / sampling], segments).ravel()
 
-        faces = stable_delaunay_faces(points, alpha)
+    valid = rmsd < rmsd_max
+    valid = np.where(valid)[0]
+    if len(valid) == 0:
+        return 0., None
 
-        segments = [points[face] for face in faces]
-        reference_area = polygon_area(template / sampling)
+    valid_area = 0.
+    for i in valid:
+        valid_area += polygon_area(points[faces[i]])
 
-        rmsd = pairwise_rmsd([template / sampling], segments).ravel()
+    valid_area_fraction = valid_area / np.prod(image.shape)
 
-        # print(sampling)
-        # import matplotlib.pyplot as plt
-        # plt.plot(*points.T,'o')
-        # plt.show()
+    area = valid_area / len(valid)
+    return valid_area_fraction, sampling * np.sqrt(reference_area / area)
 
-        valid = rmsd < rmsd_max
-        valid = np.where(valid)[0]
-        if len(valid) == 0:
-            continue
 
-        valid_area = 0.
-        for i in valid:
-            valid_area += polygon_area(points[faces[i]])
+def detect_scale_real_space(image, model, template, alpha, rmsd_max, min_sampling, max_sampling, step_size=.01,
+                            coarse_steps=8):
+    if min_sampling >= max_sampling:
+        raise RuntimeError('min_sampling must be less than max_sampling')
 
-        valid_area_fraction = valid_area / np.prod(image.shape)
+    def evaluate(sampling):
+        return evaluate_sampling(image, model, template, alpha, rmsd_max, sampling)
+
+    # coarse sweep over the sampling range, followed by a golden-section search around the best coarse sampling
+    # down to step_size
+    num_steps = max(int(np.ceil((max_sampling - min_sampling) / step_size)), 2)
+    samplings = np.linspace(min_sampling, max_sampling, min(coarse_steps, num_steps))
+    results = [evaluate(sampling) for sampling in samplings]
+    i = int(np.argmax([valid_area_fraction for valid_area_fraction, _ in results]))
+
+    if (results[i][1] is None) and (len(samplings) < num_steps):
+        # the response is narrower than the coarse stride, fall back to the full sweep
+        samplings = np.linspace(min_sampling, max_sampling, num_steps)
+        results = [evaluate(sampling) for sampling in samplings]
+        i = int(np.argmax([valid_area_fraction for valid_area_fraction, _ in results]))
+
+    max_valid, best_sampling = results[i]
+    if (best_sampling is None) or (len(samplings) == num_steps):
+        return best_sampling
+
+    a = samplings[max(i - 1, 0)]
+    b = samplings[min(i + 1, len(samplings) - 1)]
+
+    inverse_golden_ratio = (np.sqrt(5) - 1) / 2
+    c = b - inverse_golden_ratio * (b - a)
+    d = a + inverse_golden_ratio * (b - a)
+    result_c = evaluate(c)
+    result_d = evaluate(d)
+    results = [result_c, result_d]
+
+    while b - a > step_size:
+        if result_c[0] > result_d[0]:
+            b, d, result_d = d, c, result_c
+            c = b - inverse_golden_ratio * (b - a)
+            result_c = evaluate(c)
+            results.append(result_c)
+        else:
+            a, c, result_c = c, d, result_d
+            d = a + inverse_golden_ratio * (b - a)
+            result_d = evaluate(d)
+            results.append(result_d)
 
+    for valid_area_fraction, sampling in results:
         if valid_area_fraction > max_valid:
-            area = valid_area / len(valid)
-            best_sampling = sampling * np.sqrt(reference_area / area)
-            max_valid = valid_area_fraction
+            max_valid, best_sampling = valid_area_fraction, sampling
 
     return best_sampling
 
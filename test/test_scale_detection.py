@@ -1,5 +1,10 @@
 import numpy as np
-from nionswift_plugin.nionswift_structure_recognition.scale import RealSpaceCalibrator
+import pytest
+from scipy import ndimage
+from nionswift_plugin.nionswift_structure_recognition import scale
+from nionswift_plugin.nionswift_structure_recognition.model import load_preset_model
+from nionswift_plugin.nionswift_structure_recognition.scale import RealSpaceCalibrator, real_power_spectrum, \
+    interpolate_bilinear, detect_scale_real_space
 import matplotlib.pyplot as plt
 
 def test_scale_detection(test_data_1):
@@ -18,3 +23,48 @@ def test_scale_detection(test_data_1):
 
     #sampling = scale_detection_module.detect_scale(test_data_2['image'])
     #assert np.isclose(sampling, test_data_2['sampling'], rtol=.1)
+
+
+def test_real_power_spectrum():
+    for shape in [(64, 64), (65, 65), (64, 65)]:
+        image = np.random.rand(*shape)
+        assert np.allclose(real_power_spectrum(image), np.abs(np.fft.fft2(image)) ** 2)
+
+
+def test_rfft2():
+    pytest.importorskip('pyfftw')
+    image = np.random.rand(64, 65)
+    assert np.allclose(scale.rfft2(image), np.fft.rfft2(image))
+
+
+def test_interpolate_bilinear():
+    array = np.random.rand(32, 32)
+    coordinates = np.random.rand(2, 100) * 30
+    edges = np.array([[31.5, 31.99, -.5, 10., 31., 0.], [10., 31.5, 10., -.01, 31., 0.]])
+    coordinates = np.hstack((coordinates, edges))
+    assert np.allclose(interpolate_bilinear(array, coordinates), ndimage.map_coordinates(array, coordinates, order=1))
+
+
+@pytest.mark.parametrize('center, width', [(.078, .02), (.2, .005)])
+def test_detect_scale_real_space_search(monkeypatch, center, width):
+    def evaluate_sampling(image, model, template, alpha, rmsd_max, sampling):
+        if abs(sampling - center) < width:
+            return 1 - abs(sampling - center) / width, sampling
+        return 0., None
+
+    monkeypatch.setattr(scale, 'evaluate_sampling', evaluate_sampling)
+
+    sampling = detect_scale_real_space(None, None, None, None, None, .05, .3, step_size=.01)
+    assert abs(sampling - center) < .01
+
+
+def test_detect_scale_real_space_empty_range():
+    with pytest.raises(RuntimeError):
+        detect_scale_real_space(None, None, None, None, None, .1, .1)
+
+
+def test_real_space_calibrator(test_data_1):
+    model = load_preset_model('graphene')
+    calibrator = RealSpaceCalibrator(model, 'hexagonal', 2.46, min_sampling=.05, max_sampling=.15)
+    sampling = calibrator(test_data_1['image'])
+    assert np.isclose(sampling, test_data_1['sampling'], rtol=.05)